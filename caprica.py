@@ -3,19 +3,27 @@
 # Crude replacement for Galactica + DHI with built-in clock
 #
 # Imports
+import time
+STARTUP = time.monotonic()	# reference for time to first frame
 import argparse
+import asyncio
+import itertools
+import mmap
 import signal
 import queue
 import threading
-import time
 import socketserver
 import socket
+import struct
+import tempfile
+import tracemalloc
 import cairo
 import os
 import sys
+import zlib
+from collections import OrderedDict
 from unicodedata import normalize, combining
-from math import pi
-from pkg_resources import resource_filename, resource_exists
+from math import pi, isfinite
 
 # Display properties
 DEFPORT = 2004 - 58		# DHI port "58 years before the fall"
@@ -31,20 +39,432 @@ GLH = 8				# glyph height
 GLPW = 32			# number of glyphs per row in source map
 GLSZ = 0x100			# number of glyphs in source map
 FBFONT = 'unifont'		# fallback for undefined glyphs
+FBGLMAX = 256			# maximum number of cached fallback glyphs
+FBGLDISK = 1024			# maximum number of glyphs in on-disk cache
 TIMEOUT = 180			# revert to clock after timeout seconds
+TICKRATE = 1.0			# clock ticks per second
+TICKOFT = 0.01			# tick this long after wall clock boundary
+TICKALIGN = 60.0		# seconds between wall clock re-alignments
 CKH = 71			# height of clock
 CKFONT = 'NotoSans'		# font style for clock info text
 CKFH = 13.0			# height of clock info text
+CKCACHE = 4			# number of cached clock face layers
+MQHDR = 'MARQUEE'		# header for positioned text that may scroll
+MQFPS = 25.0			# maximum marquee steps per second
+MQSTEP = 1			# pixels moved per marquee step
+MQGAP = 3			# blank cells between marquee repeats
+TMHDR = 'TIMER'			# header for running timer commands
+TMRATE = 10.0			# running timer updates per second
+TMSCALE = 2			# running timer glyph scale
+TMCHARS = 7			# running timer field width
+TMGLYPHS = '0123456789:.- '	# characters in running timer atlas
 DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
 BUFLEN = 64			# read in chunks no larger than buflen
 MAXBUF = 200			# ignore message that grow larger than maxbuf
 MAXMSG = 32			# allow backlog of up to maxmsg unprocessed in
+DECCACHE = 1024			# decoded packets kept for repeated packets
+RDLEN = 4096			# async receiver read size
+MAXCONN = 8			# async receiver connection limit
+IDLETIME = 900.0		# async receiver drops idle connections
+CTLLEN = 256			# maximum length of control socket request
+CTLTIMEOUT = 1.0		# seconds to wait for control socket request
+CAPMAGIC = b'CAPRUNT4'		# capture file identifier
+CAPREC = struct.Struct('<dIH')	# capture record: time, connection, length
+CAPFLUSH = 1.0			# seconds between capture file flushes
+CAPRUN = 0			# capture connection id marking start of a run
+KEYINT = 10.0			# seconds between full frames in delta mode
+FPS = 25.0			# maximum text frame rate
+DELTAHDR = b'CAPD'		# delta frame datagram identifier
+SENDWAIT = 0.1			# seconds between retries on a blocked display
+PROFENV = 'CAPRICA_PROFILE'	# environment variable, seconds to profile
+PROFTIME = 10.0			# default profile window in seconds
+PROFRATE = 200.0		# profile stack samples per second
+PROFTOP = 25			# functions and allocations listed in profile
+PROFDEPTH = 24			# maximum stack depth sampled
+NETMAGIC = b'CAPN'		# network frame identifier
+NETHDR = struct.Struct('!4sIBHHI')	# magic, seq, flags, stride, rows, length
+NETKEY = 0x01			# network frame payload is a full frame
+NETZLIB = 0x02			# network frame payload is zlib compressed
+NETLEVEL = 6			# network frame compression level
+NETTIMEOUT = 2.0		# seconds to wait on a network display
+NETMAXDGRAM = 65507		# largest udp network frame
+A1HDR = struct.Struct('<4sHHH')	# raw A1 image: magic, width, height, stride
+A1MAGIC = b'CA1\x00'		# raw A1 image identifier
+
+def resource(name):
+    """Return the path of data file name beside module or under prefix."""
+    ret = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'data', name)
+    if not os.path.exists(ret):
+        pfx = os.path.join(sys.prefix, 'data', name)
+        if os.path.exists(pfx):
+            ret = pfx
+    return ret
 
 # Image resource files
-GLSRC = resource_filename(__name__, 'data/ISO-8859-1.png')
-CKOPEN = resource_filename(__name__, 'data/clockpip-open.png')
-CKCLOSE = resource_filename(__name__, 'data/clockpip-close.png')
-CKFACE = resource_filename(__name__, 'data/clockface-71.png')
+GLSRC = resource('ISO-8859-1.png')
+GLRAW = resource('ISO-8859-1.glyphs')
+CKOPEN = resource('clockpip-open.png')
+CKCLOSE = resource('clockpip-close.png')
+CKFACE = resource('clockface-71.png')
+
+# A1 pixels are packed into 32 bit words in host order, so the first
+# pixel of each byte is the least significant bit on little-endian hosts
+LSBFIRST = sys.byteorder == 'little'
+BREV = bytes(int('{0:08b}'.format(i)[::-1], 2) for i in range(0x100))
+
+def a1unpack(buf, stride, x, y, w, h):
+    """Return h row bitmasks of the w pixels at [x,y] in A1 buffer."""
+    ret = []
+    s = x & 7
+    nb = (s + w + 7) >> 3
+    m = (1 << w) - 1
+    o = y*stride + (x >> 3)
+    for r in range(h):
+        rb = bytes(buf[o:o+nb])
+        if not LSBFIRST:
+            rb = rb.translate(BREV)
+        ret.append((int.from_bytes(rb, 'little') >> s) & m)
+        o += stride
+    return tuple(ret)
+
+def a1save(fname, surf):
+    """Write A1 surf to fname as a raw A1 image."""
+    surf.flush()
+    data = bytes(surf.get_data())
+    if not LSBFIRST:
+        data = data.translate(BREV)
+    with open(fname, 'wb') as f:
+        f.write(A1HDR.pack(A1MAGIC, surf.get_width(), surf.get_height(),
+                           surf.get_stride()))
+        f.write(data)
+
+def a1load(fname):
+    """Return an A1 image surface mapped from raw A1 image fname."""
+    with open(fname, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    (magic, w, h, stride) = A1HDR.unpack_from(mm)
+    if magic != A1MAGIC or len(mm) < A1HDR.size + stride*h or \
+            stride != cairo.ImageSurface.format_stride_for_width(
+                                                 cairo.FORMAT_A1, w):
+        raise ValueError('invalid raw A1 image')
+    data = memoryview(mm)[A1HDR.size:A1HDR.size + stride*h]
+    if not LSBFIRST:
+        data = bytearray(bytes(data).translate(BREV))
+    return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_A1,
+                                              w, h, stride)
+
+def a1image(fname):
+    """Load PNG image fname, from its raw A1 version when available."""
+    raw = os.path.splitext(fname)[0] + '.a1'
+    if os.path.exists(raw):
+        try:
+            return a1load(raw)
+        except Exception as e:
+            print('caprica: Error reading {}: {}'.format(raw, repr(e)))
+    return cairo.ImageSurface.create_from_png(fname)
+
+def deltaframe(prev, cur, stride):
+    """Return a delta datagram for the rows of cur that differ from prev.
+
+    The datagram is DELTAHDR followed by one or more row ranges, each
+    a network order unsigned short first row and row count, then the
+    bytes of the changed rows. None is returned if no row differs.
+    """
+    pv = memoryview(prev)
+    cv = memoryview(cur)
+    ret = bytearray(DELTAHDR)
+    nrows = len(cur) // stride
+    r = 0
+    while r < nrows:
+        o = r*stride
+        if pv[o:o+stride] != cv[o:o+stride]:
+            first = r
+            r += 1
+            while r < nrows:
+                o = r*stride
+                if pv[o:o+stride] == cv[o:o+stride]:
+                    break
+                r += 1
+            ret += struct.pack('!HH', first, r-first)
+            ret += cv[first*stride:r*stride]
+        r += 1
+    if len(ret) == len(DELTAHDR):
+        return None
+    return bytes(ret)
+
+def applydelta(frame, buf, stride):
+    """Copy the rows of delta datagram buf into frame in place."""
+    buf = memoryview(buf)
+    o = len(DELTAHDR)
+    if bytes(buf[0:o]) != DELTAHDR:
+        raise ValueError('not a delta frame')
+    while o < len(buf):
+        (first, count) = struct.unpack_from('!HH', buf, o)
+        o += 4
+        fo = first*stride
+        n = count*stride
+        if fo + n > len(frame) or o + n > len(buf):
+            raise ValueError('delta rows exceed frame')
+        frame[fo:fo+n] = buf[o:o+n]
+        o += n
+
+def netaddr(spec):
+    """Return (proto, (host, port)) for a udp:// or tcp:// display."""
+    (proto, sep, addr) = spec.strip().partition('://')
+    proto = proto.lower()
+    if proto not in ('udp', 'tcp'):
+        raise ValueError('unknown display transport ' + repr(proto))
+    (host, sep, port) = addr.rpartition(':')
+    return (proto, (host or 'localhost', int(port)))
+
+def a1blit(buf, stride, bw, bh, x, y, rows, w, over=False):
+    """Write w pixel row bitmasks into A1 buffer of size bw,bh at [x,y].
+
+    Pixels outside the buffer are clipped. When over is set, bits
+    are merged with the existing pixels, otherwise they replace them.
+    """
+    if x < 0:
+        rows = [r >> -x for r in rows]
+        w += x
+        x = 0
+    if x + w > bw:
+        w = bw - x
+    if w <= 0:
+        return
+    s = x & 7
+    nb = (s + w + 7) >> 3
+    m = (1 << w) - 1
+    cm = ~(m << s)
+    o = y*stride + (x >> 3)
+    for r in rows:
+        if y >= bh:
+            break
+        if y >= 0:
+            rb = bytes(buf[o:o+nb])
+            if not LSBFIRST:
+                rb = rb.translate(BREV)
+            v = int.from_bytes(rb, 'little')
+            if over:
+                v |= (r & m) << s
+            else:
+                v = (v & cm) | ((r & m) << s)
+            rb = v.to_bytes(nb, 'little')
+            if not LSBFIRST:
+                rb = rb.translate(BREV)
+            buf[o:o+nb] = rb
+        y += 1
+        o += stride
+
+def a1scale(rows, w, n):
+    """Return w pixel row bitmasks scaled by n in both directions."""
+    px = (1 << n) - 1
+    ret = []
+    for r in rows:
+        v = 0
+        for x in range(w):
+            if r >> x & 1:
+                v |= px << (x*n)
+        ret.extend([v] * n)
+    return ret
+
+def tmparse(t):
+    """Return seconds for a time of the form [[h:]m:]s[.d]."""
+    ret = 0.0
+    for part in t.split(':'):
+        ret = 60.0*ret + float(part)
+    return ret
+
+def a1png(data, stride, w, h):
+    """Return a 1 bit greyscale PNG of A1 buffer data, lit pixels white."""
+    def chunk(kind, body):
+        return (struct.pack('!I', len(body)) + kind + body
+                + struct.pack('!I', zlib.crc32(kind + body)))
+    nb = (w + 7) >> 3
+    raw = bytearray()
+    for y in range(h):
+        row = bytes(data[y*stride:y*stride+nb])
+        if LSBFIRST:
+            row = row.translate(BREV)	# PNG packs first pixel in MSB
+        raw += b'\x00' + row
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('!IIBBBBB', w, h, 1, 0, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(bytes(raw)))
+            + chunk(b'IEND', b''))
+
+# Runtime counters and histograms
+class histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds	# upper bound of each bucket
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def add(self, v):
+        """Add observation v to the histogram."""
+        i = 0
+        for b in self.bounds:
+            if v <= b:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += v
+        if self.max is None or v > self.max:
+            self.max = v
+
+    def __str__(self):
+        ret = 'count={0} mean={1:0.3f} max={2}'.format(self.count,
+                    self.total/self.count if self.count else 0.0, self.max)
+        for b, c in zip(self.bounds + ['inf'], self.counts):
+            ret += ' le_{0}={1}'.format(b, c)
+        return ret
+
+class metrics(object):
+    # Histogram bucket bounds
+    MSBOUNDS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250]
+    DEPTHBOUNDS = [0, 1, 2, 4, 8, 16, 32]
+    COUNTBOUNDS = [1, 10, 100, 1000, 10000, 100000]
+    STARTBOUNDS = [0.5, 1, 2, 5, 10, 30]
+    JITTERBOUNDS = [0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 500]
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__c = {}
+        self.__h = {}
+        self.__start = time.time()
+
+    def count(self, name, n=1):
+        """Increment counter name by n."""
+        with self.__lock:
+            self.__c[name] = self.__c.get(name, 0) + n
+
+    def value(self, name):
+        """Return the current value of counter name."""
+        with self.__lock:
+            return self.__c.get(name, 0)
+
+    def observe(self, name, v, bounds=MSBOUNDS):
+        """Add observation v to histogram name."""
+        with self.__lock:
+            if name not in self.__h:
+                self.__h[name] = histogram(bounds)
+            self.__h[name].add(v)
+
+    def dump(self):
+        """Return a text report of all counters and histograms."""
+        with self.__lock:
+            ret = 'uptime {0:0.1f}\n'.format(time.time() - self.__start)
+            for k in sorted(self.__c):
+                ret += '{0} {1}\n'.format(k, self.__c[k])
+            for k in sorted(self.__h):
+                ret += '{0} {1}\n'.format(k, self.__h[k])
+        return ret
+
+STATS = metrics()
+
+# Sampling profiler, idle unless a window is requested
+class profiler(object):
+    def __init__(self, outdir=None):
+        self.outdir = outdir or tempfile.gettempdir()
+        self.__lock = threading.Lock()
+        self.__active = None	# filename of profile being gathered
+
+    def start(self, duration=PROFTIME):
+        """Profile all threads for duration, return output filename.
+
+        None is returned if a profile window is already running.
+        """
+        with self.__lock:
+            if self.__active is not None:
+                return None
+            self.__active = os.path.join(self.outdir,
+                    time.strftime('caprica-profile-%Y%m%d-%H%M%S.txt'))
+        t = threading.Thread(target=self.__run,
+                             args=(self.__active, duration))
+        t.daemon = True
+        t.start()
+        return self.__active
+
+    def __sample(self, stacks, own):
+        """Add the current stack of each thread to stacks."""
+        names = {t.ident:t.name for t in threading.enumerate()}
+        for (tid, f) in sys._current_frames().items():
+            if tid == own:
+                continue
+            st = []
+            while f is not None and len(st) < PROFDEPTH:
+                co = f.f_code
+                st.append('{0}:{1}({2})'.format(
+                          os.path.basename(co.co_filename),
+                          co.co_name, f.f_lineno))
+                f = f.f_back
+            key = (names.get(tid, str(tid)), tuple(reversed(st)))
+            stacks[key] = stacks.get(key, 0) + 1
+
+    def __run(self, fname, duration):
+        try:
+            self.__profile(fname, duration)
+        except Exception as e:
+            print('caprica: Profile error: ' + repr(e))
+        finally:
+            with self.__lock:
+                self.__active = None
+
+    def __profile(self, fname, duration):
+        """Sample stacks and allocations for duration, then write fname."""
+        print('caprica: Profiling for {0:0.1f}s'.format(duration))
+        stacks = {}
+        own = threading.get_ident()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        count = 0
+        try:
+            snap = tracemalloc.take_snapshot()
+            iv = 1.0/PROFRATE
+            nt = time.monotonic()
+            end = nt + duration
+            while nt < end:
+                self.__sample(stacks, own)
+                count += 1
+                nt += iv
+                dt = nt - time.monotonic()
+                if dt > 0:
+                    time.sleep(dt)
+            allocs = tracemalloc.take_snapshot().compare_to(snap, 'lineno')
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+        with open(fname, 'w') as f:
+            f.write(self.__report(stacks, count, allocs))
+        print('caprica: Wrote profile ' + fname)
+
+    def __report(self, stacks, count, allocs):
+        """Return the text of a profile report."""
+        ret = '# {0} samples at {1:0.0f}/s\n'.format(count, PROFRATE)
+        threads = {}
+        for ((name, st), n) in stacks.items():
+            threads.setdefault(name, []).append((st, n))
+        for name in sorted(threads):
+            own = {}
+            total = 0
+            for (st, n) in threads[name]:
+                total += n
+                if st:
+                    own[st[-1]] = own.get(st[-1], 0) + n
+            ret += '\n# thread {0}: {1} samples\n'.format(name, total)
+            for (fn, n) in sorted(own.items(), key=lambda i: -i[1])[:PROFTOP]:
+                ret += '{0:6.1f}% {1}\n'.format(100.0*n/total, fn)
+        ret += '\n# collapsed stacks\n'
+        for ((name, st), n) in sorted(stacks.items(), key=lambda i: -i[1]):
+            ret += '{0} {1}\n'.format(';'.join((name,) + st), n)
+        ret += '\n# allocation growth\n'
+        for a in allocs[:PROFTOP]:
+            ret += str(a) + '\n'
+        return ret
+
+PROFILE = profiler()
 
 # UNT4 message wrapper (based on metarace unt4 lib)
 class unt4(object):
@@ -74,9 +494,19 @@ class unt4(object):
         self.xx = xx            # input column 0-99
         self.yy = yy            # input row 0-99
         self.text = text.translate(self.tmap) # strip UNT4 controls from text
+        self.utext = self.text.upper()	# upper-cased text for result lines
         if unt4str is not None:
             self.unpack(unt4str)
 
+    def __setattr__(self, name, value):
+        if self.__dict__.get('frozen'):
+            raise AttributeError('unt4 message is read only')
+        object.__setattr__(self, name, value)
+
+    def freeze(self):
+        """Make this message read only, so it may be shared."""
+        self.frozen = True
+
     def unpack(self, unt4str=''):
         """Unpack the UNT4 data into this object."""
         if len(unt4str) > 2 and ord(unt4str[0]) == self.SOH[0] \
@@ -121,6 +551,169 @@ class unt4(object):
                 self.yy = int(dlebuf[2:])
             self.header = newhead
             self.text = normalize('NFC', newtext)
+            self.utext = self.text.upper()
+
+    def decode(self, pkt=b''):
+        """Unpack the UNT4 packet bytes into this object."""
+        if len(pkt) > 2 and pkt[0] == self.SOH[0] and pkt[-1] == self.EOT[0]:
+            self.prefix = None
+            (head, stx, text) = bytes(pkt[1:-1]).partition(self.STX)
+            pi = max(head.rfind(self.DC2), head.rfind(self.DC3),
+                     head.rfind(self.DC4))
+            if pi >= 0:
+                self.prefix = head[pi]  # assume pfx before head text
+                head = head.translate(None, self.DC2+self.DC3+self.DC4)
+            dlebuf = b''
+            i = text.find(self.DLE)
+            if i >= 0:
+                dlebuf = text[i+1:i+5]
+                text = text[:i] + text[i+5:]
+            self.erl = self.ERL in text
+            self.erp = self.ERP in text
+            if len(dlebuf) == 4 and dlebuf.isdigit():
+                self.xx = int(dlebuf[:2])
+                self.yy = int(dlebuf[2:])
+            self.header = head.decode('utf-8','ignore')
+            self.text = normalize('NFC', text.translate(None,
+                   self.STX+self.ERL+self.ERP+self.DLE).decode('utf-8','ignore'))
+            self.utext = self.text.upper()
+
+# Shared cache of decoded packets, repeated packets skip decoding
+class unt4cache(object):
+    def __init__(self, maxsize=DECCACHE):
+        self.maxsize = maxsize
+        self.__lock = threading.Lock()
+        self.__c = OrderedDict()
+
+    def decode(self, pkt):
+        """Return a read only unt4 message for packet bytes pkt."""
+        with self.__lock:
+            m = self.__c.get(pkt)
+            if m is not None:
+                self.__c.move_to_end(pkt)
+        if m is not None:
+            STATS.count('decode_hits')
+            return m
+        STATS.count('decode_misses')
+        m = unt4()
+        m.decode(pkt)
+        m.freeze()
+        if self.maxsize > 0:
+            with self.__lock:
+                self.__c[pkt] = m
+                while len(self.__c) > self.maxsize:
+                    self.__c.popitem(last=False)
+        return m
+
+UNT4CACHE = unt4cache()
+
+# Incremental UNT4 packet parser
+class unt4parser(object):
+    def __init__(self, maxbuf=MAXBUF, cap=None, cid=0):
+        self.__buf = bytearray()
+        self.__scan = 0		# buffer offset already searched for EOT
+        self.__maxbuf = maxbuf
+        self.__cap = cap	# optional packet capture
+        self.__cid = cid	# connection id for capture records
+
+    def reset(self):
+        """Discard any partially received packet."""
+        del self.__buf[:]
+        self.__scan = 0
+
+    def feed(self, data):
+        """Append data to the stream and yield each complete packet."""
+        buf = self.__buf
+        buf += data
+        pos = 0
+        while True:
+            st = buf.find(unt4.SOH, pos)
+            if st < 0:
+                # no packet start, discard everything
+                pos = len(buf)
+                self.__scan = 0
+                break
+            end = buf.find(unt4.EOT, max(st + 1, self.__scan))
+            if end < 0:
+                # keep partial packet, resume search at end of buffer
+                pos = st
+                self.__scan = len(buf) - st
+                break
+            st = buf.rfind(unt4.SOH, st, end)	# resync on last SOH
+            pkt = bytes(buf[st:end+1])
+            if self.__cap is not None:
+                self.__cap.record(self.__cid, pkt)
+            m = UNT4CACHE.decode(pkt)
+            del buf[:end+1]	# consumed, even if the caller stops early
+            pos = 0
+            self.__scan = 0
+            yield m
+        del buf[:pos]
+
+        # check if there's too much garbage in the stream
+        if len(buf) > self.__maxbuf:
+            self.reset()
+
+# Timestamped capture of received packets
+class capture(object):
+    def __init__(self, filename):
+        self.__lock = threading.Lock()
+        self.__f = open(filename, 'ab')
+        if self.__f.tell() == 0:
+            self.__f.write(CAPMAGIC)
+        self.__nf = time.monotonic() + CAPFLUSH
+        self.record(CAPRUN, b'')	# monotonic times restart with each run
+
+    def record(self, cid, pkt):
+        """Append packet bytes received on connection cid."""
+        now = time.monotonic()
+        with self.__lock:
+            self.__f.write(CAPREC.pack(now, cid, len(pkt)))
+            self.__f.write(pkt)
+            if now > self.__nf:
+                self.__f.flush()
+                self.__nf = now + CAPFLUSH
+
+    def close(self):
+        with self.__lock:
+            self.__f.close()
+
+def captured(filename):
+    """Yield time, connection id and packet bytes from a capture file.
+
+    Packets are memoryviews of the file, released when the generator
+    resumes or is closed. Each run appended to the file is moved to
+    start where the previous run ended, so times never go backwards.
+    """
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(CAPMAGIC):
+            raise ValueError('not a capture file: ' + repr(filename))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[0:len(CAPMAGIC)] != CAPMAGIC:
+                raise ValueError('not a capture file: ' + repr(filename))
+            o = len(CAPMAGIC)
+            base = 0.0	# offset of current run from first run
+            last = None
+            with memoryview(mm) as mv:
+                while o + CAPREC.size <= len(mm):
+                    (ts, cid, plen) = CAPREC.unpack_from(mm, o)
+                    o += CAPREC.size
+                    if o + plen > len(mm):
+                        break	# record truncated by an unclean exit
+                    pkt = mv[o:o+plen]
+                    o += plen
+                    if cid == CAPRUN:
+                        if last is not None:
+                            base = last - ts
+                        pkt.release()
+                        continue
+                    last = ts + base
+                    try:
+                        yield (last, cid, pkt)
+                    finally:
+                        pkt.release()	# allow mmap to close early
+
+CONNID = itertools.count(1)	# DHI connection ids
 
 # TCP/IP message receiver and socket server
 socketserver.TCPServer.allow_reuse_address = True
@@ -128,90 +721,786 @@ socketserver.TCPServer.request_queue_size = 4
 class recvhandler(socketserver.BaseRequestHandler):
     def handle(self):
         """Receive message from TCP"""
-        data = b''
+        p = unt4parser(cap=self.server.cap, cid=next(CONNID))
+        cnt = 0
+        STATS.count('connections')
         while True:
             nd = self.request.recv(BUFLEN)
             if len(nd) == 0:
                 break
-            data += nd
-            while unt4.SOH[0] in data:
-                (buf, sep, data) = data.partition(unt4.SOH)
-                data = sep + data
-                if unt4.EOT[0] in data:
-                    (buf, sep, data) = data.partition(unt4.EOT)
-                    mstr = (buf+unt4.EOT).decode('utf-8','ignore')
-                    m = unt4(unt4str=mstr)
-                    if self.server.tbh is not None and m is not None:
-                        self.server.tbh.update(m)
-                else:
-                    break
-
-            # check if there's too much garbage in the stream
-            if len(data) > MAXBUF:
-                data = b''
+            for m in p.feed(nd):
+                cnt += 1
+                if self.server.tbh is not None:
+                    self.server.tbh.update(m)
+        STATS.count('packets', cnt)
+        STATS.observe('packets_per_conn', cnt, metrics.COUNTBOUNDS)
 
 class receiver(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    tbh = None
+    cap = None
+    def set_tableau(self, th=None):
+        self.tbh = th
+
+    def set_capture(self, cap=None):
+        self.cap = cap
+
+# asyncio message receiver, alternative to receiver
+class areceiver(object):
+    def __init__(self, addr, maxconn=MAXCONN, idle=IDLETIME):
+        self.tbh = None
+        self.cap = None
+        self.__maxconn = maxconn
+        self.__idle = idle
+        self.__nconn = 0
+        self.__conns = {}	# handler tasks and writers of open connections
+        self.__closing = False
+        self.__loop = None
+        self.__srv = None
+        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.__sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__sock.bind(addr)
+        self.__sock.listen(maxconn)
+        self.server_address = self.__sock.getsockname()
+
     def set_tableau(self, th=None):
         self.tbh = th
 
+    def set_capture(self, cap=None):
+        self.cap = cap
+
+    async def __handle(self, reader, writer):
+        """Receive messages from a single DHI connection."""
+        if self.__nconn >= self.__maxconn:
+            print('caprica: Too many connections, refused {}'.format(
+                    writer.get_extra_info('peername')))
+            writer.close()
+            return
+        self.__nconn += 1
+        self.__conns[asyncio.current_task()] = writer
+        p = unt4parser(cap=self.cap, cid=next(CONNID))
+        cnt = 0
+        STATS.count('connections')
+        try:
+            while True:
+                nd = await asyncio.wait_for(reader.read(RDLEN), self.__idle)
+                if len(nd) == 0 or self.__closing:
+                    break
+                for m in p.feed(nd):
+                    cnt += 1
+                    if self.tbh is not None:
+                        self.tbh.update(m)
+        except asyncio.TimeoutError:
+            print('caprica: Closed idle connection {}'.format(
+                    writer.get_extra_info('peername')))
+        except OSError:
+            pass
+        finally:
+            self.__nconn -= 1
+            del self.__conns[asyncio.current_task()]
+            STATS.count('packets', cnt)
+            STATS.observe('packets_per_conn', cnt, metrics.COUNTBOUNDS)
+            writer.close()
+
+    async def __serve(self):
+        self.__loop = asyncio.get_running_loop()
+        self.__srv = await asyncio.start_server(self.__handle,
+                                                sock=self.__sock)
+        await self.__srv.serve_forever()
+
+    def serve_forever(self):
+        """Run the receiver event loop until shutdown."""
+        try:
+            asyncio.run(self.__serve())
+        except asyncio.CancelledError:
+            pass
+
+    async def __stop(self):
+        """Close open connections, wait for their handlers, then stop."""
+        self.__closing = True	# discard data already buffered
+        tasks = list(self.__conns)
+        for w in self.__conns.values():
+            w.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__srv.close()
+
+    def shutdown(self):
+        """Stop the receiver event loop after closing open connections."""
+        if self.__loop is not None and self.__loop.is_running():
+            f = asyncio.run_coroutine_threadsafe(self.__stop(), self.__loop)
+            try:
+                f.result(CTLTIMEOUT)
+            except Exception:
+                pass	# loop stopped before connections were closed
+
+# Pending message queue, newer updates supersede older ones
+class msgqueue(object):
+    def __init__(self, maxsize=MAXMSG):
+        self.__maxsize = maxsize
+        self.__cv = threading.Condition()
+        self.__q = OrderedDict()	# pending messages, oldest first
+        self.__seq = itertools.count()	# unique keys for unkeyed messages
+        self.__unfinished = 0
+
+    def __key(self, msg):
+        """Return the pending message key for msg."""
+        if msg is None or msg.erp:
+            return next(self.__seq)
+        key = (msg.header, msg.yy, msg.xx)
+        old = self.__q.get(key)
+        if old is not None and not msg.erl and (old.erl
+                or self.__cells(msg) < self.__cells(old)):
+            # msg does not completely overwrite old, keep both
+            return next(self.__seq)
+        return key
+
+    def __cells(self, msg):
+        """Return the number of display cells written by msg."""
+        text = msg.text
+        if msg.yy is not None and msg.yy > 1:
+            text = msg.utext	# result rows are upper-cased
+        return sum(1 for c in text if not combining(c))
+
+    def __evict(self):
+        """Discard the oldest pending message, keeping any ERP."""
+        for (key, old) in self.__q.items():
+            if old is None or not old.erp:
+                del self.__q[key]
+                return
+        # only general clearings are pending, keep the newest
+        self.__q.popitem(last=False)
+        STATS.count('erp_evicted')
+
+    def qsize(self):
+        with self.__cv:
+            return len(self.__q)
+
+    def put(self, msg, block=False):
+        """Add msg, return False if an older message was discarded.
+
+        A message to the same header and position as a pending one
+        replaces it, and a general clearing cancels everything pending.
+        When the queue is full the oldest message other than a pending
+        general clearing is discarded, unless block is set, in which
+        case put waits for space.
+        """
+        ret = True
+        with self.__cv:
+            if msg is not None and msg.erp:
+                STATS.count('messages_superseded', len(self.__q))
+                self.__unfinished -= len(self.__q)
+                self.__q.clear()
+            key = self.__key(msg)
+            if key in self.__q:
+                STATS.count('messages_superseded')
+                del self.__q[key]
+            else:
+                while block and len(self.__q) >= self.__maxsize:
+                    self.__cv.wait()
+                if len(self.__q) >= self.__maxsize:
+                    self.__evict()
+                    self.__unfinished -= 1
+                    ret = False
+                self.__unfinished += 1
+            self.__q[key] = msg
+            self.__cv.notify_all()
+        return ret
+
+    def get(self, block=True, timeout=None):
+        """Remove and return the oldest message, or raise queue.Empty."""
+        with self.__cv:
+            if block and not self.__q:
+                self.__cv.wait_for(lambda: self.__q, timeout)
+            if not self.__q:
+                raise queue.Empty
+            ret = self.__q.popitem(last=False)[1]
+            self.__cv.notify_all()
+            return ret
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def task_done(self):
+        with self.__cv:
+            self.__unfinished -= 1
+            self.__cv.notify_all()
+
+    def join(self):
+        """Block until every message added has been marked done."""
+        with self.__cv:
+            self.__cv.wait_for(lambda: self.__unfinished <= 0)
+
+# Monotonic tick scheduler aligned to wall clock
+class ticker(object):
+    def __init__(self, rate=TICKRATE):
+        self.__period = 1.0/rate
+        self.__next = 0.0	# monotonic time of next tick
+        self.__realign = 0.0	# monotonic time of next alignment
+        self.align()
+
+    def align(self):
+        """Schedule next tick just after a wall clock period boundary."""
+        mono = time.monotonic()
+        frac = time.time() % self.__period
+        self.__next = mono + self.__period - frac + TICKOFT
+        self.__realign = mono + TICKALIGN
+
+    def timeout(self, now):
+        """Return seconds from now until the next tick."""
+        return max(0.0, self.__next - now)
+
+    def due(self, now):
+        """Return True and schedule the next tick if a tick is due."""
+        if now < self.__next:
+            return False
+        STATS.observe('tick_jitter_ms', 1000.0*(now - self.__next),
+                      metrics.JITTERBOUNDS)
+        if now >= self.__realign:
+            self.align()
+        else:
+            self.__next += self.__period
+            if self.__next <= now:
+                # skip over missed ticks rather than bunching them
+                missed = int((now - self.__next)/self.__period) + 1
+                STATS.count('ticks_missed', missed)
+                self.__next += missed * self.__period
+        return True
+
+# Glyph bitmaps shared by all tableaus
+class glyphset(object):
+    def __init__(self, preload='', cachedir=None):
+        self.__lock = threading.Lock()
+        self.__fbglcache = OrderedDict()	# least recently used first
+        self.__pinned = {}	# preloaded glyphs, never expired
+        self.__cachedir = cachedir
+        self.__ncached = 0	# number of glyphs in cachedir
+        self.atlas = None
+        if os.path.exists(GLRAW):
+            try:
+                self.atlas = rawatlas(GLRAW)
+            except Exception as e:
+                print('caprica: Error reading {}: {}'.format(GLRAW, repr(e)))
+        if self.atlas is None:
+            self.atlas = pngatlas(GLSRC)
+
+        # index custom bitmaps, then pin cached and preloaded glyphs
+        self.__index = {}
+        gldir = os.path.dirname(GLSRC)
+        for fname in os.listdir(gldir):
+            if fname.startswith('unichr-') and fname.endswith('.png'):
+                try:
+                    self.__index[int(fname[7:-4], 16)] = os.path.join(
+                                                          gldir, fname)
+                except ValueError:
+                    pass
+        if cachedir is not None:
+            self.__load_cache()
+        for c in preload:
+            if ord(c) >= GLSZ and c not in self.__pinned:
+                self.__pinned[c] = self.__render_char(c)
+
+    def __load_cache(self):
+        """Pin all previously rendered glyphs found in the cache dir."""
+        try:
+            os.makedirs(self.__cachedir, exist_ok=True)
+            for fname in os.listdir(self.__cachedir):
+                if fname.startswith('unichr-') and fname.endswith('.glyph'):
+                    self.__ncached += 1
+                    with open(os.path.join(self.__cachedir, fname), 'rb') as f:
+                        rows = f.read()
+                    if len(rows) == GLH:
+                        self.__pinned[chr(int(fname[7:-6], 16))] = tuple(rows)
+        except Exception as e:
+            print('caprica: Error reading glyph cache: ' + repr(e))
+
+    def __save_glyph(self, c, rows):
+        """Write the rendered glyph rows for c to the cache dir."""
+        if self.__ncached < FBGLDISK:
+            fname = os.path.join(self.__cachedir,
+                                 'unichr-{0:#07x}.glyph'.format(ord(c)))
+            try:
+                with open(fname, 'wb') as f:
+                    f.write(bytes(rows))
+                self.__ncached += 1
+            except Exception as e:
+                print('caprica: Error writing glyph cache: ' + repr(e))
+
+    def glyph(self, c):
+        """Return row masks for character c."""
+        cord = ord(c)
+        if cord < GLSZ:
+            return self.atlas[cord]
+        ret = self.__pinned.get(c)
+        if ret is not None:
+            return ret
+        with self.__lock:
+            if c in self.__fbglcache:
+                self.__fbglcache.move_to_end(c)
+                return self.__fbglcache[c]
+            ret = self.__render_char(c)
+            self.__fbglcache[c] = ret
+            if len(self.__fbglcache) > FBGLMAX:
+                self.__fbglcache.popitem(last=False)
+            if self.__cachedir is not None and cord not in self.__index:
+                self.__save_glyph(c, ret)
+        return ret
+
+    def __render_char(self, c):
+        """Use manual then fallback font to render a missing glyph."""
+        STATS.count('glyphs_rendered')
+        gs = cairo.ImageSurface(cairo.FORMAT_A1, GLW, GLH)
+        ctx = cairo.Context(gs)
+        fname = self.__index.get(ord(c))
+        if fname is not None:
+            # use a custom bitmap
+            try:
+                ctx.set_source_surface(
+                         cairo.ImageSurface.create_from_png(fname), 0, 0)
+                ctx.paint()
+                gs.flush()
+                print('caprica: Loaded glyph \'{}\'from {}'.format(c, fname))
+                return a1unpack(gs.get_data(), gs.get_stride(),
+                                0, 0, GLW, GLH)
+            except Exception as e:
+                print('caprica: Error reading glyph {} from {}: {}'.format(
+                        c, fname, repr(e)))
+
+        # use a sloppy rendering of the unifont glyph
+        ctx.set_operator(cairo.Operator.SOURCE)
+        ctx.set_source_rgba(0,0,0,0)
+        ctx.paint()
+        ctx.set_source_rgba(0,0,0,1)
+        ctx.select_font_face(FBFONT)
+        fontmat = cairo.Matrix(xx=11.0, yy=10.0)
+        ctx.set_font_matrix(fontmat)
+        ctx.move_to(-1.0,7.0)
+        ctx.show_text(c)
+        gs.flush()
+        return a1unpack(gs.get_data(), gs.get_stride(), 0, 0, GLW, GLH)
+
+def pngatlas(fname):
+    """Return glyph row masks read from atlas image fname."""
+    gls = cairo.ImageSurface(cairo.FORMAT_A1, GLH*GLPW, GLH*(GLSZ//GLPW))
+    # read in font png, render to A1 then unpack into glyph row masks
+    tmpc = cairo.Context(gls)
+    tmps = cairo.ImageSurface.create_from_png(fname)
+    tmpc.set_source_surface(tmps,0,0)
+    tmpc.paint()
+    gls.flush()
+    gld = gls.get_data()
+    gst = gls.get_stride()
+    return [a1unpack(gld, gst, GLH*(g%GLPW), GLH*(g//GLPW), GLW, GLH)
+              for g in range(GLSZ)]
+
+def rawatlas(fname):
+    """Return glyph row masks mapped from raw atlas fname."""
+    with open(fname, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) != GLSZ*GLH:
+                raise ValueError('invalid raw glyph atlas')
+            return [mm[g*GLH:(g+1)*GLH] for g in range(GLSZ)]
+
+def charset(spec):
+    """Return the characters in spec, expanding U+XXXX[-U+YYYY] ranges."""
+    ret = ''
+    for tok in spec.split():
+        if tok.upper().startswith('U+'):
+            (first, sep, last) = tok.upper().partition('-')
+            try:
+                first = int(first[2:], 16)
+                last = int(last[2:], 16) if sep else first
+            except ValueError:
+                raise argparse.ArgumentTypeError('invalid range ' + repr(tok))
+            ret += ''.join(chr(i) for i in range(first, last+1))
+        else:
+            ret += tok
+    return normalize('NFC', ret)
+
+# Local control socket
+class ctlhandler(socketserver.StreamRequestHandler):
+    timeout = CTLTIMEOUT
+    def handle(self):
+        """Answer a single control request, default is stats."""
+        cmd = []
+        try:
+            cmd = self.rfile.readline(CTLLEN).decode('ascii','ignore').split()
+        except socket.timeout:
+            pass
+        if not cmd or cmd[0] == 'stats':
+            self.wfile.write(STATS.dump().encode('ascii'))
+        elif cmd[0] == 'profile':
+            try:
+                duration = PROFTIME
+                if len(cmd) > 1:
+                    duration = float(cmd[1])
+                fname = PROFILE.start(duration)
+                if fname is None:
+                    self.wfile.write(b'error: profile already running\n')
+                else:
+                    self.wfile.write('profile {}\n'.format(fname).encode())
+            except ValueError:
+                self.wfile.write(b'error: invalid profile duration\n')
+        elif cmd[0] == 'frame':
+            self.frame(cmd[1:])
+        else:
+            self.wfile.write(b'error: unknown command\n')
+
+    def frame(self, args):
+        """Write the last frame: frame [display|text|clock] [raw|png] [BOARD]"""
+        kind = 'display'
+        png = True
+        board = 0
+        for a in args:
+            if a in ('display', 'text', 'clock'):
+                kind = a
+            elif a in ('raw', 'png'):
+                png = a == 'png'
+            elif a.isdigit():
+                board = int(a)
+            else:
+                self.wfile.write(b'error: invalid frame request\n')
+                return
+        tbls = []
+        if self.server.tbh is not None:
+            tbls = self.server.tbh.tableaus()
+        if board >= len(tbls):
+            self.wfile.write(b'error: no such board\n')
+            return
+        snap = tbls[board].snapshot(kind, png)
+        if snap is None:
+            self.wfile.write(b'error: no frame\n')
+            return
+        (w, h, stride) = tbls[board].size()
+        self.wfile.write('frame {0} {1} {2} {3} {4}\n'.format(
+                         snap[0], w, h, stride, len(snap[1])).encode('ascii'))
+        self.wfile.write(snap[1])
+
+class control(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    def __init__(self, path, handler):
+        self.tbh = None
+        if os.path.exists(path):
+            os.unlink(path)	# remove stale socket
+        socketserver.UnixStreamServer.__init__(self, path, handler)
+
+    def set_tableau(self, tbh):
+        """Serve frame snapshots from the tableaus of router tbh."""
+        self.tbh = tbh
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        os.unlink(self.server_address)
+
+# Display frame sender, latest submitted frame wins
+class sender(threading.Thread):
+    def __init__(self, fba, delta=False, keyint=KEYINT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.running = True
+        self.__net = None	# network transport, udp or tcp
+        self.__seq = 0		# sequence number of last network frame
+        self.__neterr = False	# network display is unreachable
+        if '://' in fba:
+            (self.__net, self.__fba) = netaddr(fba)
+            delta = True
+        else:
+            self.__fba = fba.strip().lstrip('\0@')
+        self.__fb = None
+        if self.__net != 'tcp':
+            family = socket.AF_UNIX
+            if self.__net == 'udp':
+                # resolve once, not on every frame
+                (family, st, pr, cn, self.__fba) = socket.getaddrinfo(
+                        self.__fba[0], self.__fba[1], 0, socket.SOCK_DGRAM)[0]
+            self.__fb = socket.socket(family, socket.SOCK_DGRAM)
+            self.__fb.setblocking(False)
+        self.__delta = delta	# send dirty-row delta frames
+        self.__keyint = keyint
+        self.__nkf = 0.0	# time of next full frame
+        self.__lf = None	# last frame written to display
+        self.__ff = True	# first frame not yet sent
+        self.__cv = threading.Condition()
+        self.__back = None	# latest submitted frame
+        self.__stride = 0
+        self.__pending = False
+
+    def keyframe(self):
+        """Request a full frame on the next display update."""
+        with self.__cv:
+            self.__lf = None
+
+    def submit(self, data, stride):
+        """Queue immutable frame bytes data, replacing any unsent frame."""
+        with self.__cv:
+            if self.__pending:
+                STATS.count('frames_skipped')
+            self.__back = data
+            self.__stride = stride
+            self.__pending = True
+            self.__cv.notify()
+
+    def stop(self):
+        with self.__cv:
+            self.running = False
+            self.__cv.notify()
+
+    def __encode(self, frame, stride):
+        """Return the datagram for frame, or None if display is current."""
+        if not self.__delta:
+            return frame
+        ret = frame
+        lf = self.__lf
+        now = time.monotonic()
+        if lf is not None and len(lf) == len(frame) and now < self.__nkf:
+            ret = deltaframe(lf, frame, stride)
+            if ret is None or len(ret) < len(frame):
+                return ret
+            ret = frame
+        self.__nkf = now + self.__keyint
+        return ret
+
+    def __netframe(self, buf, frame, stride):
+        """Wrap datagram buf in a sequence numbered network frame."""
+        flags = 0
+        if buf is frame:
+            flags |= NETKEY
+        z = zlib.compress(buf, NETLEVEL)
+        if len(z) < len(buf):
+            buf = z
+            flags |= NETZLIB
+        seq = (self.__seq + 1) & 0xffffffff
+        return NETHDR.pack(NETMAGIC, seq, flags, stride,
+                           len(frame)//stride, len(buf)) + buf
+
+    def __connect(self):
+        """Open the tcp display connection, return True on success."""
+        try:
+            self.__fb = socket.create_connection(self.__fba, NETTIMEOUT)
+        except Exception as e:
+            STATS.count('connect_errors')
+            if not self.__neterr:
+                self.__neterr = True
+                print('caprica: Error connecting to display: ' + repr(e))
+            return False
+        self.__neterr = False
+        self.__lf = None	# new connection starts with a full frame
+        return True
+
+    def __write(self, buf):
+        if self.__net == 'tcp':
+            self.__fb.sendall(buf)
+        else:
+            self.__fb.sendto(buf, self.__fba)
+
+    def __send(self, frame, stride):
+        """Write frame to the display socket without blocking."""
+        if self.__fb is None and not self.__connect():
+            return
+        buf = self.__encode(frame, stride)
+        if buf is None:
+            return	# display is already showing frame
+        if self.__net is not None:
+            buf = self.__netframe(buf, frame, stride)
+            if self.__net == 'udp' and len(buf) > NETMAXDGRAM:
+                STATS.count('frames_oversize')
+                self.__lf = None
+                if not self.__neterr:
+                    self.__neterr = True
+                    print('caprica: Frame of {} bytes exceeds udp limit, '
+                          'use a tcp display'.format(len(buf)))
+                return
+        while True:
+            try:
+                self.__write(buf)
+                break
+            except BlockingIOError:
+                # display is backed up, retry unless a newer frame arrives
+                STATS.count('sendto_blocked')
+                with self.__cv:
+                    self.__cv.wait_for(
+                            lambda: self.__pending or not self.running,
+                            SENDWAIT)
+                    if self.__pending or not self.running:
+                        # frame is stale, send the newer one instead
+                        STATS.count('frames_skipped')
+                        return
+            except Exception as e:
+                STATS.count('sendto_errors')
+                self.__lf = None
+                if self.__net == 'tcp':
+                    self.__fb.close()
+                    self.__fb = None
+                print('caprica: Error sending frame: ' + repr(e))
+                return
+        if self.__net is not None:
+            self.__seq = (self.__seq + 1) & 0xffffffff
+        STATS.count('frames_sent')
+        STATS.count('bytes_sent', len(buf))
+        if self.__ff:
+            self.__ff = False
+            tff = time.monotonic() - STARTUP
+            STATS.observe('first_frame_s', tff, metrics.STARTBOUNDS)
+            print('caprica: First frame after {0:0.3f}s'.format(tff))
+        if self.__delta:
+            self.__lf = frame
+
+    def run(self):
+        while True:
+            with self.__cv:
+                while self.running and not self.__pending:
+                    self.__cv.wait()
+                if not self.running:
+                    break
+                frame = self.__back
+                stride = self.__stride
+                self.__pending = False
+            self.__send(frame, stride)
+        if self.__fb is not None:
+            self.__fb.close()
+
 # Graphic renderer
 class tableau(threading.Thread):
-    def __init__(self, x, y, fba):
+    def __init__(self, x, y, fba, delta=False, keyint=KEYINT, fps=FPS,
+                 glyphs=None, tickrate=TICKRATE):
         threading.Thread.__init__(self)
         self.running = False
-        self.__fb = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        fba = fba.strip().lstrip('\0@')
-        self.__fba = fba
-        self.__q = queue.Queue(maxsize=MAXMSG)
-        self.__lu = TIMEOUT+1
+        self.__fs = sender(fba, delta, keyint)
+        self.__fi = 1.0/fps	# minimum interval between text frames
+        self.__txd = False	# text surface has unsent changes
+        self.__q = msgqueue(MAXMSG)
+        self.__tk = ticker(tickrate)
+        self.__sweep = tickrate > 1.0	# smooth seconds hand
+        self.__lu = None	# time of last text update, None if expired
         self.__lt = True
         self.__w = x
         self.__h = y
         self.__d = {'DC':None, 'RH':None, 'BP':None}
         self.__cols = self.__w // GLW
         self.__rows = (self.__h - HDRGAP) // LINEH
+        # text matrix of all cells at least partly visible on the display
+        mrows = 0
+        while self.__line_offset(mrows) < self.__h:
+            mrows += 1
+        self.__blank = [' '] * -(-self.__w // GLW)
+        self.__cells = [list(self.__blank) for r in range(mrows)]
+        self.__mq = {}		# scrolling text rows
+        self.__mqi = max(self.__fi, 1.0/MQFPS)	# marquee step interval
+        self.__mqn = 0.0	# time of next marquee step
+        self.__tm = None	# running timer
+        self.__tmn = 0.0	# time of next running timer update
         self.__cks = cairo.ImageSurface(cairo.FORMAT_A1, self.__w, self.__h)
         self.__ckc = cairo.Context(self.__cks)
         self.__ckc.set_operator(cairo.Operator.SOURCE)
         self.__ckc.set_line_width(0.75)
         self.__ckrot = pi/30.0
+        # face and hour/minute hands are pre-rendered on a layer surface
+        self.__cls = cairo.ImageSurface(cairo.FORMAT_A1, self.__w, self.__h)
+        self.__clc = cairo.Context(self.__cls)
+        self.__clc.set_operator(cairo.Operator.SOURCE)
+        self.__ckl = OrderedDict()
         self.__ckc.select_font_face(CKFONT)
         self.__ckc.set_font_size(CKFH)
-        self.__ckf = cairo.ImageSurface.create_from_png(CKFACE)
-        self.__ckop = cairo.ImageSurface.create_from_png(CKOPEN)
-        self.__ckcp = cairo.ImageSurface.create_from_png(CKCLOSE)
+        self.__ckf = a1image(CKFACE)
+        self.__ckop = a1image(CKOPEN)
+        self.__ckcp = a1image(CKCLOSE)
+        # text is written directly into the A1 buffer, not through cairo
         self.__txs = cairo.ImageSurface(cairo.FORMAT_A1, self.__w, self.__h)
-        self.__txc = cairo.Context(self.__txs)
-        self.__txc.set_operator(cairo.Operator.SOURCE)
-        self.__fbglcache = {}
-        self.__gls = cairo.ImageSurface(cairo.FORMAT_A1,
-                                        GLH*GLPW, GLH*(GLSZ//GLPW))
-        # read in font png and render to A1 glyph cache
-        tmpc = cairo.Context(self.__gls)
-        tmps = cairo.ImageSurface.create_from_png(GLSRC)
-        tmpc.set_source_surface(tmps,0,0)
-        tmpc.paint()
-        self.__gls.flush()
-
-    def update(self, msg=None):
-        """Queue a tableau update."""
-        try:
-            self.__q.put_nowait(msg)
-        except queue.Full:
-            print('caprica: Message queue full, discarded message')
-            return None
+        self.__txb = self.__txs.get_data()
+        self.__txst = self.__txs.get_stride()
+        self.__txz = bytes(len(self.__txb))
+        if glyphs is None:
+            glyphs = glyphset()
+        self.__gl = glyphs
+        self.__glm = glyphs.atlas
+        self.__tmg = {c:a1scale(self.__glyph(c), GLW, TMSCALE)
+                      for c in TMGLYPHS}
+        self.__gen = 0		# frames sent
+        self.__snap = {}	# last frame of each kind for snapshots
+        self.__png = {}		# snapshots encoded on request
+
+    def keyframe(self):
+        """Request a full frame on the next display update."""
+        self.__fs.keyframe()
+
+    def __send_frame(self, surf, kind):
+        """Submit a copy of surf to the sender, keeping it for snapshots."""
+        data = bytes(surf.get_data())
+        self.__gen += 1
+        self.__snap[kind] = (self.__gen, data)	# replaced whole, no lock
+        self.__snap['display'] = self.__snap[kind]
+        self.__fs.submit(data, surf.get_stride())
+
+    def snapshot(self, kind='display', png=False):
+        """Return (generation, data) of the last text, clock or display frame.
+
+        Data is the raw A1 buffer, or a PNG encoded on first request
+        and kept until the next frame of that kind. None is returned
+        if no frame of kind has been sent.
+        """
+        snap = self.__snap.get(kind)
+        if snap is None or not png:
+            return snap
+        (gen, data) = snap
+        cached = self.__png.get(kind)
+        if cached is None or cached[0] != gen:
+            cached = (gen, a1png(data, self.__txst, self.__w, self.__h))
+            self.__png[kind] = cached
+        return cached
+
+    def size(self):
+        """Return the display width, height and frame stride."""
+        return (self.__w, self.__h, self.__txst)
+
+    def update(self, msg=None, wait=False):
+        """Queue a tableau update, return False if a message was discarded."""
+        if not self.__q.put(msg, wait):
+            STATS.count('messages_dropped')
+            print('caprica: Message queue full, discarded oldest message')
+            return False
+        return True
+
+    def wait(self):
+        """Block until all queued updates have been taken for display."""
+        self.__q.join()
 
     def __clock_hand(self, a, l, w):
         """Draw a clock hand of length l from [0,0] rotated to a"""
-        self.__ckc.save()
-        self.__ckc.rotate(a*self.__ckrot)
-        self.__ckc.move_to(0,-l)
-        self.__ckc.line_to(0.5*w,0)
-        self.__ckc.line_to(0,0.4*w)
-        self.__ckc.line_to(-0.5*w,0)
-        self.__ckc.line_to(0,-l)
-        self.__ckc.fill()
-        self.__ckc.restore()
+        self.__clc.save()
+        self.__clc.rotate(a*self.__ckrot)
+        self.__clc.move_to(0,-l)
+        self.__clc.line_to(0.5*w,0)
+        self.__clc.line_to(0,0.4*w)
+        self.__clc.line_to(-0.5*w,0)
+        self.__clc.line_to(0,-l)
+        self.__clc.fill()
+        self.__clc.restore()
+
+    def __clock_layer(self, oft, hour, minute):
+        """Return face with hour and minute hands, from cache if possible."""
+        key = (oft[0], oft[1], hour, minute)
+        if key in self.__ckl:
+            self.__ckl.move_to_end(key)
+            return self.__ckl[key]
+
+        # Place background then add hands
+        self.__clc.save()
+        self.__clc.set_source_surface(self.__ckf, oft[0], oft[1])
+        self.__clc.paint()
+        self.__clc.restore()
+        self.__clc.save()
+        self.__clc.translate(oft[0]+0.5*CKH, oft[1]+0.5*CKH)
+        self.__clock_hand(5*(hour%12)+minute//12, 17, 6)
+        self.__clock_hand(minute, 25, 5)
+        self.__clc.restore()
+        self.__cls.flush()
+
+        # Keep the whole frame and the rows of the clock area
+        data = bytes(self.__cls.get_data())
+        ret = (data, a1unpack(data, self.__cls.get_stride(),
+                              0, 0, CKH+2, CKH+1))
+        self.__ckl[key] = ret
+        if len(self.__ckl) > CKCACHE:
+            self.__ckl.popitem(last=False)
+        return ret
 
     def __clock_secs(self, a, l, head=True):
         """Draw a seconds hand of length l from [0,0] rotated to a"""
@@ -259,23 +1548,27 @@ class tableau(threading.Thread):
         """Re-draw clock and output to display."""
         ctr = [[0,0], [1,0], [2,0],
                [2,1], [1,1], [0,1]]
-        nc = time.localtime()
+        now = time.time()
+        nc = time.localtime(now)
         oft = ctr[nc.tm_yday % len(ctr)]	# 'screen saver'
 
-        # Place background then add hands.
-        self.__ckc.save()
-        if not self.__lt:
-            # clock was last frame output
-            self.__ckc.rectangle(0, 0, CKH+2, CKH+1)
-            self.__ckc.clip()
-        self.__ckc.set_source_surface(self.__ckf, oft[0], oft[1])
-        self.__ckc.paint()
-        self.__ckc.restore()
+        # Copy cached background and hands then add seconds.
+        (data, rows) = self.__clock_layer(oft, nc.tm_hour, nc.tm_min)
+        self.__cks.flush()
+        buf = self.__cks.get_data()
+        if self.__lt:
+            buf[:] = data
+        else:
+            # clock was last frame output, keep info text and pips
+            a1blit(buf, self.__cks.get_stride(), self.__w, self.__h,
+                   0, 0, rows, CKH+2)
+        self.__cks.mark_dirty()
         self.__ckc.save()
         self.__ckc.translate(oft[0]+0.5*CKH, oft[1]+0.5*CKH)
-        self.__clock_hand(5*(nc.tm_hour%12)+nc.tm_min//12, 17, 6)
-        self.__clock_hand(nc.tm_min, 25, 5)
-        self.__clock_secs(min(59, nc.tm_sec), 32)
+        secs = min(59, nc.tm_sec)
+        if self.__sweep:
+            secs += now % 1.0
+        self.__clock_secs(secs, 32)
         self.__ckc.restore()
 
         # Add informative text when available.
@@ -332,106 +1625,310 @@ class tableau(threading.Thread):
 
         # Write frame to display socket
         self.__cks.flush()
-        try:
-            self.__fb.sendto(self.__cks.get_data(), self.__fba)
-            self.__lt = False
-        except Exception as e:
-            print('caprica: Error sending clock: ' + repr(e))
+        self.__send_frame(self.__cks, 'clock')
+        self.__lt = False
 
-    def __render_char(self, c):
-        """Use manual then fallback font to render a missing glyph."""
-        sfile = 'data/unichr-{0:#07x}.png'.format(ord(c))
-        if resource_exists(__name__, sfile):
-            # use a custom bitmap
-            try:
-                fname = resource_filename(__name__, sfile)
-                self.__fbglcache[c] = cairo.ImageSurface.create_from_png(fname)
-                print('caprica: Loaded glyph \'{}\'from {}'.format(c, fname))
-            except Exception as s:
-                print('caprica: Error reading glyph {} from {}: {}'.format(
-                        c, fname, repr(e)))
-        if c not in self.__fbglcache:
-            # use a sloppy rendering of the unifont glyph
-            self.__fbglcache[c] = cairo.ImageSurface(cairo.FORMAT_A1, 6,8)
-            ctx = cairo.Context(self.__fbglcache[c])
-            ctx.select_font_face(FBFONT)
-            fontmat = cairo.Matrix(xx=11.0, yy=10.0)
-            ctx.set_font_matrix(fontmat)
-            ctx.move_to(-1.0,7.0)
-            ctx.show_text(c)
-            self.__fbglcache[c].flush()
-
-    def __overlay_char(self, c, x, y):
-        self.__txc.save()
-        self.__txc.set_operator(cairo.Operator.OVER)
-        self.__place_char(c, x, y)
-        self.__txc.restore()
-
-    def __place_char(self, c, x, y):
+    def __glyph(self, c):
+        """Return the row bitmasks for character c."""
         cord = ord(c)
-        self.__txc.save()
-        self.__txc.rectangle(x,y,GLW,GLH)
-        self.__txc.clip()
-
         if cord < GLSZ:
-            yo = y-GLH*(cord//GLPW)
-            xo = x-GLH*(cord%GLPW)
-            self.__txc.set_source_surface(self.__gls, xo, yo)
-            self.__txc.paint()
+            return self.__glm[cord]
+        return self.__gl.glyph(c)
+
+    def __place_char(self, c, x, y, over=False):
+        """Write glyph for c into the text buffer at [x,y]."""
+        a1blit(self.__txb, self.__txst, self.__w, self.__h,
+               x, y, self.__glyph(c), GLW, over)
+
+    def __line_offset(self, yy):
+        """Return the vertical pixel offset of text row yy."""
+        vo = LINEH * yy
+        if yy > 1:
+            vo += HDRGAP
+        return vo
+
+    def __place_cell(self, cell, x, y):
+        """Write a base character and its combining marks at [x,y]."""
+        self.__place_char(cell[0], x, y)
+        for c in cell[1:]:
+            # overwrite base char
+            self.__place_char(c, x, y, True)
+
+    def __start_marquee(self, row, yy, xx, text):
+        """Scroll text on row yy from column xx if it does not fit.
+
+        The whole line is rendered once into a strip of row bitmasks,
+        each doubled so any window of the display width is a shift
+        and mask. Return False if text fits, starts off the display or
+        shares its row with the timer, and was not started.
+        """
+        if xx*GLW >= self.__w:
+            return False
+        if self.__tm is not None and any(c[0] == yy
+                                         for c in self.__tm['cells']):
+            return False	# row is partly drawn by the timer
+        cells = []
+        for c in text:
+            if not combining(c):
+                cells.append(c)
+            elif cells:
+                cells[-1] += c
+        if len(cells) <= self.__cols - xx:
+            return False
+
+        period = GLW * (len(cells) + MQGAP)
+        strip = [0] * GLH
+        for (i, cell) in enumerate(cells):
+            for c in cell:
+                for (r, bits) in enumerate(self.__glyph(c)):
+                    strip[r] |= bits << (i*GLW)
+        if not self.__mq:
+            self.__mqn = time.monotonic() + self.__mqi
+        x = xx * GLW
+        self.__mq[yy] = {'vo':self.__line_offset(yy), 'x':x,
+                         'w':self.__w - x, 'period':period, 'pos':0,
+                         'col':xx, 'text':text,
+                         'rows':[r | (r << period) for r in strip]}
+        for col in range(xx, len(row)):
+            row[col] = ' '	# cells under marquee are drawn by strip
+        self.__draw_marquee(self.__mq[yy])
+        return True
+
+    def __stop_marquee(self, yy):
+        """Cancel scrolling on row yy and blank its area."""
+        mq = self.__mq.pop(yy)
+        a1blit(self.__txb, self.__txst, self.__w, self.__h,
+               mq['x'], mq['vo'], [0] * GLH, mq['w'])
+
+    def __draw_marquee(self, mq):
+        """Write the visible window of a marquee into the text buffer."""
+        pos = mq['pos']
+        m = (1 << mq['w']) - 1
+        a1blit(self.__txb, self.__txst, self.__w, self.__h, mq['x'],
+               mq['vo'], [(r >> pos) & m for r in mq['rows']], mq['w'])
+
+    def __step_marquee(self):
+        """Move all marquees along by MQSTEP pixels."""
+        st = time.perf_counter()
+        for mq in self.__mq.values():
+            mq['pos'] = (mq['pos'] + MQSTEP) % mq['period']
+            self.__draw_marquee(mq)
+        self.__txd = True
+        STATS.observe('render_marquee_ms', 1000.0*(time.perf_counter() - st))
+
+    def __timer_text(self, et):
+        """Return the running timer field for et elapsed seconds.
+
+        Times of an hour or more are shown as h:mm:ss, and times that
+        do not fit the field are held at its largest value.
+        """
+        d = max(0, int(et*TMRATE + 1e-6))
+        (s, t) = divmod(d, int(TMRATE))
+        (m, s) = divmod(s, 60)
+        (h, m) = divmod(m, 60)
+        if h:
+            ret = '{0}:{1:02d}:{2:02d}'.format(h, m, s)
+        elif m:
+            ret = '{0}:{1:02d}.{2}'.format(m, s, t)
         else:
-            if c not in self.__fbglcache:
-                self.__render_char(c)
-            self.__txc.set_source_surface(self.__fbglcache[c],x,y)
-            self.__txc.paint()
-           
-        self.__txc.restore()
+            ret = '{0}.{1}'.format(s, t)
+        if len(ret) > TMCHARS:
+            ret = '9' * (TMCHARS - 6) + ':59:59'	# saturate
+        return ret.rjust(TMCHARS)
+
+    def __draw_timer(self, text):
+        """Repaint the running timer digits that differ from text."""
+        tm = self.__tm
+        gw = GLW*TMSCALE
+        for (i, c) in enumerate(text):
+            if c != tm['text'][i]:
+                a1blit(self.__txb, self.__txst, self.__w, self.__h,
+                       tm['x'] + i*gw, tm['y'],
+                       self.__tmg.get(c, self.__tmg[' ']), gw)
+                self.__txd = True
+        tm['text'] = text
+
+    def __step_timer(self, now):
+        """Update a running timer from the local clock."""
+        st = time.perf_counter()
+        tm = self.__tm
+        et = now - tm['ref']
+        d = max(0, int(et*TMRATE + 1e-6))
+        self.__tmn = tm['ref'] + (d + 1)/TMRATE
+        self.__draw_timer(self.__timer_text(et))
+        self.__lu = now		# running timer keeps text on display
+        STATS.observe('render_timer_ms', 1000.0*(time.perf_counter() - st))
+
+    def __timer_cells(self, x, y):
+        """Return the set of text cells overlapped by a timer at [x,y]."""
+        ret = set()
+        tw = TMCHARS*GLW*TMSCALE
+        th = GLH*TMSCALE
+        for yy in range(len(self.__cells)):
+            vo = self.__line_offset(yy)
+            if vo < y + th and vo + GLH > y:
+                for col in range(len(self.__cells[yy])):
+                    if col*GLW < x + tw and col*GLW + GLW > x:
+                        ret.add((yy, col))
+        return ret
+
+    def __timer_command(self, msg):
+        """Apply a running timer command, return True if text changed.
+
+        START [TIME] runs the timer from TIME, the elapsed time when
+        the command was sent, STOP [TIME] holds it at TIME or its
+        current value, and CLEAR removes it. A positioned command
+        places the timer with its top left at cell xx, yy, otherwise
+        it is at the bottom right of the display.
+        """
+        words = msg.text.split()
+        if not words:
+            return False
+        cmd = words[0].upper()
+        now = time.monotonic()
+        try:
+            et = None
+            if len(words) > 1:
+                et = tmparse(words[1])
+                if not isfinite(et*TMRATE):
+                    raise ValueError('time out of range')
+        except ValueError:
+            print('caprica: Invalid timer command: ' + repr(msg.text))
+            return False
+        dirty = False
+        if self.__expired():
+            # re-displaying from the clock, start with a blank page
+            self.__erase_page()
+            dirty = True
+        if cmd == 'CLEAR':
+            if self.__tm is not None:
+                self.__draw_timer(' ' * TMCHARS)
+                self.__tm = None
+                dirty = True
+            return dirty
+        if cmd not in ('START', 'STOP'):
+            print('caprica: Unknown timer command: ' + repr(cmd))
+            return dirty
+
+        if self.__tm is None or msg.yy is not None:
+            x = self.__w - TMCHARS*GLW*TMSCALE
+            y = self.__h - GLH*TMSCALE
+            if msg.yy is not None:
+                x = msg.xx*GLW
+                y = self.__line_offset(msg.yy)
+            if self.__tm is not None:
+                self.__draw_timer(' ' * TMCHARS)
+            # force a full repaint at the new position
+            self.__tm = {'x':x, 'y':y, 'ref':now, 'run':False,
+                         'held':0.0, 'text':'\0' * TMCHARS,
+                         'cells':self.__timer_cells(x, y)}
+            for yy in set(c[0] for c in self.__tm['cells']):
+                if yy in self.__mq:
+                    self.__stop_marquee(yy)	# would overwrite digits
+            for (yy, col) in self.__tm['cells']:
+                # text under the timer is dropped from the matrix
+                self.__cells[yy][col] = ' '
+                self.__place_char(' ', col*GLW, self.__line_offset(yy))
+        tm = self.__tm
+        if cmd == 'START':
+            tm['ref'] = now - (et or 0.0)
+            tm['run'] = True
+            self.__step_timer(now)
+        else:
+            if et is None:
+                et = tm['held']
+                if tm['run']:
+                    et = now - tm['ref']
+            tm['run'] = False
+            tm['held'] = et
+            self.__draw_timer(self.__timer_text(et))
+        return True
 
     def __erase_page(self):
-        self.__txc.save()
-        self.__txc.set_source_rgba(0,0,0,0)
-        self.__txc.paint()
-        self.__txc.restore()
+        """Clear all text, return True if any cell was not blank."""
+        ret = bool(self.__mq) or self.__tm is not None
+        self.__mq.clear()
+        self.__tm = None
+        for row in self.__cells:
+            if row != self.__blank:
+                row[:] = self.__blank
+                ret = True
+        self.__txb[:] = self.__txz
+        return ret
 
     def __show_text(self, msg=None):
-        """Update text frame and send to display."""
+        """Apply message to text model and render the changed cells."""
         ret = False
         if isinstance(msg, unt4):
             dirty = False
             if msg.erp:
-                # General clearing
+                # General clearing, blank page replaces a clock frame
                 ret = True
-                dirty = True
-                self.__erase_page()
+                dirty = (self.__erase_page() or not self.__lt
+                         or self.__expired())
+            elif msg.header == TMHDR:
+                # Running timer command
+                dirty = self.__timer_command(msg)
+                ret = dirty	# ignored commands leave the timeout alone
             elif msg.yy is not None:
                 # Positioned text
 
                 # If re-displaying from the clock, blank whole page
-                if self.__lu > TIMEOUT:
+                if self.__expired():
                     self.__erase_page()
+                    dirty = True
 
                 ret = True
-                vo = LINEH * msg.yy
-                if msg.yy > 1:
-                    vo += HDRGAP
-                ho = msg.xx * GLW
-                if msg.yy > 1:	# all non-headers are upper-cased
-                    msg.text = msg.text.upper() # THIS MAY NOT BE THE SAME LEN
-                for c in msg.text:
-                    if not combining(c):
-                        self.__place_char(c, ho, vo)
-                        ho += GLW
-                    else:
-                        # overwrite previous char, don't advace
-                        self.__overlay_char(c, ho-GLW, vo)
-                    dirty = True
-                if msg.erl:
-                    self.__txc.save()
-                    self.__txc.rectangle(ho,vo,self.__w-ho,GLH)
-                    self.__txc.clip()
-                    self.__txc.set_source_rgba(0,0,0,0)
-                    self.__txc.paint() 
-                    self.__txc.restore()
-                    dirty = True
+                if msg.yy < len(self.__cells):
+                    row = self.__cells[msg.yy]
+                    text = msg.text
+                    if msg.yy > 1:	# all non-headers are upper-cased
+                        text = msg.utext # THIS MAY NOT BE THE SAME LEN
+                    mq = self.__mq.get(msg.yy)
+                    if mq is not None:
+                        if (msg.header == MQHDR and msg.xx == mq['col']
+                                and text == mq['text']):
+                            return ret	# repeated line, keep scrolling
+                        end = len(row)
+                        if not msg.erl:
+                            end = msg.xx + sum(1 for c in text
+                                               if not combining(c))
+                        over = max(msg.xx, mq['col']) < min(end, len(row))
+                        if over or msg.header == MQHDR:
+                            # new text over the scrolling text replaces it
+                            self.__stop_marquee(msg.yy)
+                            dirty = True
+                    if msg.header == MQHDR and self.__start_marquee(
+                                             row, msg.yy, msg.xx, text):
+                        self.__txd = True
+                        return ret
+                    nr = list(row)
+                    col = msg.xx
+                    for c in text:
+                        if not combining(c):
+                            if col < len(nr):
+                                nr[col] = c
+                            col += 1
+                        elif 0 < col <= len(nr):
+                            # add to previous char, don't advance
+                            nr[col-1] += c
+                    if msg.erl:
+                        while col < len(nr):
+                            nr[col] = ' '
+                            col += 1
+
+                    # render only the cells that changed
+                    vo = self.__line_offset(msg.yy)
+                    covered = ()
+                    if self.__tm is not None:
+                        covered = self.__tm['cells']
+                    for col in range(len(nr)):
+                        if (msg.yy, col) in covered:
+                            continue	# cell is drawn by the timer
+                        if nr[col] != row[col]:
+                            row[col] = nr[col]
+                            self.__place_cell(nr[col], col*GLW, vo)
+                            dirty = True
             elif msg.header in ['DC','RH','BP']:
                 # Info message - temp, pressure, humidity
                 nv = None
@@ -443,38 +1940,264 @@ class tableau(threading.Thread):
 
             elif msg.header == 'OVERLAY 01':
                 # expire the timer to force re-display of fac clock
-                self.__lu = TIMEOUT + 1
+                self.__lu = None
+                self.__mq.clear()
+                self.__tm = None
 
             if dirty:
-                # Write frame to display socket
-                self.__txs.flush()
-                try:
-                    self.__fb.sendto(self.__txs.get_data(), self.__fba)
-                    self.__lt = True
-                except Exception as e:
-                    print('caprica: Error sending text: ' + repr(e))
+                self.__txd = True
         return ret
-        
+
+    def __flush_text(self):
+        """Write text frame to display socket."""
+        self.__txd = False
+        self.__txs.mark_dirty()
+        self.__send_frame(self.__txs, 'text')
+        self.__lt = True
+
+    def __expired(self):
+        """Return True if the text display has timed out."""
+        return self.__lu is None or time.monotonic() - self.__lu > TIMEOUT
+
+    def __tick(self):
+        """Process a clock tick."""
+        if self.__expired():
+            self.__lu = None
+            self.__txd = False	# clock replaces pending text
+            self.__mq.clear()
+            self.__tm = None
+            st = time.perf_counter()
+            self.__show_clock()
+            STATS.observe('render_clock_ms',
+                          1000.0*(time.perf_counter() - st))
+
+    def __process(self, m):
+        """Apply a single queued message."""
+        if m is None:
+            # Process an explicit clock tick request
+            self.__tick()
+        else:
+            # Process a text update
+            st = time.perf_counter()
+            if self.__show_text(m):
+                self.__lu = time.monotonic()	# reset timeout
+            STATS.observe('render_text_ms', 1000.0*(time.perf_counter() - st))
+
     def run(self):
         self.running = True
+        self.__fs.start()
+        nf = 0.0	# earliest time for next text frame
+        try:
+            # show clock without waiting for the first tick
+            self.__show_clock()
+        except Exception as e:
+            print('caprica: Tableau exception: ' + repr(e))
         while self.running:
             try:
-                m = self.__q.get(timeout=2.0)
+                now = time.monotonic()
+                if self.__tk.due(now):
+                    self.__tick()
+                if self.__mq and now >= self.__mqn:
+                    self.__mqn += self.__mqi
+                    if self.__mqn < now:
+                        self.__mqn = now + self.__mqi	# fell behind
+                    self.__step_marquee()
+                tmr = self.__tm is not None and self.__tm['run']
+                if tmr and now >= self.__tmn:
+                    self.__step_timer(now)
+                tmout = self.__tk.timeout(now)
+                if self.__mq:
+                    tmout = min(tmout, max(0.0, self.__mqn - now))
+                if tmr:
+                    tmout = min(tmout, max(0.0, self.__tmn - now))
+                if self.__txd:
+                    tmout = min(tmout, max(0.0, nf - now))
+                STATS.observe('queue_depth', self.__q.qsize(),
+                              metrics.DEPTHBOUNDS)
+                m = self.__q.get(timeout=tmout)
                 self.__q.task_done()
-                if m is None:
-                    # Process a clock tick notification
-                    self.__lu += 1
-                    if self.__lu > TIMEOUT:
-                        self.__show_clock()
-                else:
-                    # Process a text update
-                    if self.__show_text(m):
-                        self.__lu = 0	# reset counter
+                self.__process(m)
+
+                # apply everything already queued before drawing a frame
+                for i in range(MAXMSG):
+                    m = self.__q.get_nowait()
+                    self.__q.task_done()
+                    self.__process(m)
             except queue.Empty:
                 pass
             except Exception as e:
                 print('caprica: Tableau exception: ' + repr(e))
                 running = False
+            if self.__txd:
+                now = time.monotonic()
+                if now >= nf:
+                    self.__flush_text()
+                    nf = now + self.__fi
+        self.__fs.stop()
+
+# Message router for one or more tableaus
+class router(object):
+    def __init__(self):
+        self.__routes = []
+
+    def add(self, tbh, headers=None, rows=None, offset=0):
+        """Route messages to tbh.
+
+        When headers is provided, only messages with one of the listed
+        headers are routed. When rows is a (first, last) pair, only
+        positioned text on those rows is routed. Row numbers are
+        reduced by offset before delivery, and rows above offset
+        are not routed.
+        """
+        self.__routes.append((tbh, headers, rows, offset))
+
+    def tableaus(self):
+        """Return the list of routed tableaus."""
+        return [r[0] for r in self.__routes]
+
+    def keyframe(self):
+        """Request a full frame from all tableaus."""
+        for r in self.__routes:
+            r[0].keyframe()
+
+    def update(self, msg=None, wait=False):
+        """Queue msg on matching tableaus, return False if discarded."""
+        ret = True
+        for (tbh, headers, rows, offset) in self.__routes:
+            m = msg
+            if m is not None:
+                if headers is not None and m.header not in headers:
+                    continue
+                if m.yy is not None:
+                    if rows is not None and not rows[0] <= m.yy <= rows[1]:
+                        continue
+                    if offset:
+                        if m.yy < offset:
+                            continue	# row is above this board
+                        m = unt4(prefix=m.prefix, header=m.header,
+                                 erp=m.erp, erl=m.erl, xx=m.xx,
+                                 yy=m.yy-offset, text=m.text)
+            if not tbh.update(m, wait):
+                ret = False
+        return ret
+
+def boardspec(spec):
+    """Parse a board specification of comma separated key=value pairs."""
+    ret = {'path':None, 'width':WIDTH, 'height':HEIGHT,
+           'headers':None, 'rows':None, 'offset':0}
+    try:
+        for kv in spec.split(','):
+            (k, sep, v) = kv.partition('=')
+            k = k.strip()
+            if k == 'path':
+                ret['path'] = v
+            elif k == 'size':
+                (w, h) = v.lower().split('x')
+                ret['width'] = int(w)
+                ret['height'] = int(h)
+            elif k == 'header':
+                if ret['headers'] is None:
+                    ret['headers'] = set()
+                ret['headers'].add(v)
+            elif k == 'rows':
+                (first, last) = v.split('-')
+                ret['rows'] = (int(first), int(last))
+            elif k == 'offset':
+                ret['offset'] = int(v)
+            else:
+                raise ValueError('unknown key ' + repr(k))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError('invalid board {}: {}'.format(
+                                          repr(spec), e))
+    if not ret['path']:
+        raise argparse.ArgumentTypeError('board {} has no path'.format(
+                                          repr(spec)))
+    if ret['rows'] is not None and ret['offset'] > ret['rows'][0]:
+        raise argparse.ArgumentTypeError(
+                'board {} offset is beyond its first row'.format(repr(spec)))
+    return ret
+
+# Network display relay
+class netdecoder(object):
+    """Rebuild full frames from a stream of network frames."""
+    def __init__(self):
+        self.frame = None
+        self.__seq = None
+
+    def decode(self, hdr, payload):
+        """Return the full frame after applying packet, or None."""
+        (magic, seq, flags, stride, rows, length) = hdr
+        if magic != NETMAGIC or length != len(payload) or not stride:
+            raise ValueError('invalid network frame')
+        expect = (self.__seq is not None
+                  and seq == (self.__seq + 1) & 0xffffffff)
+        self.__seq = seq
+        if flags & NETZLIB:
+            payload = zlib.decompress(payload)
+        if flags & NETKEY:
+            if len(payload) != stride*rows:
+                raise ValueError('full frame length mismatch')
+            self.frame = bytearray(payload)
+        elif (not expect or self.frame is None
+                or len(self.frame) != stride*rows):
+            # missed a frame, wait for the next full frame
+            STATS.count('relay_dropped')
+            self.frame = None
+            return None
+        else:
+            applydelta(self.frame, payload, stride)
+        return self.frame
+
+class relaytcphandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        dec = netdecoder()
+        try:
+            while True:
+                hdr = self.rfile.read(NETHDR.size)
+                if len(hdr) < NETHDR.size:
+                    break
+                hdr = NETHDR.unpack(hdr)
+                payload = self.rfile.read(hdr[5])
+                frame = dec.decode(hdr, payload)
+                if frame is not None:
+                    self.server.write(frame)
+        except Exception as e:
+            print('caprica: Error reading network frame: ' + repr(e))
+
+class relayudphandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data = self.request[0]
+        try:
+            hdr = NETHDR.unpack_from(data)
+            frame = self.server.dec.decode(hdr, data[NETHDR.size:])
+            if frame is not None:
+                self.server.write(frame)
+        except Exception as e:
+            STATS.count('relay_errors')
+            print('caprica: Error reading network frame: ' + repr(e))
+
+class relayserver(object):
+    """Mixin writing decoded frames to a local display socket."""
+    def set_display(self, fba):
+        self.dec = netdecoder()
+        self.fb = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.fb.setblocking(False)
+        self.fba = fba.strip().lstrip('\0@')
+
+    def write(self, frame):
+        try:
+            self.fb.sendto(frame, self.fba)
+            STATS.count('frames_sent')
+        except Exception as e:
+            STATS.count('sendto_errors')
+            print('caprica: Error sending frame: ' + repr(e))
+
+class relaytcp(relayserver, socketserver.TCPServer):
+    allow_reuse_address = True
+
+class relayudp(relayserver, socketserver.UDPServer):
+    allow_reuse_address = True
+    max_packet_size = 65535
 
 def main():
     # Check command line options
@@ -482,9 +2205,60 @@ def main():
     parser.add_argument('-p', '--port',
                         help='DHI port number [' + str(DEFPORT) + ']',
                         type=int, default=DEFPORT)
+    parser.add_argument('--async',
+                        help='Use asyncio DHI receiver',
+                        dest='aio', action='store_true')
+    parser.add_argument('--maxconn',
+                        help='Async receiver connection limit ['
+                              + str(MAXCONN) + ']',
+                        type=int, default=MAXCONN)
+    parser.add_argument('--idle',
+                        help='Async receiver idle timeout seconds ['
+                              + str(IDLETIME) + ']',
+                        type=float, default=IDLETIME)
     parser.add_argument('-d', '--display',
-                        help='Display socket [' + str(DEFFB) + ']',
+                        help='Display socket, udp://HOST:PORT or '
+                             'tcp://HOST:PORT [' + str(DEFFB) + ']',
                         type=str, default=DEFFB)
+    parser.add_argument('--delta',
+                        help='Send dirty-row delta frames to display socket',
+                        action='store_true')
+    parser.add_argument('--keyframe',
+                        help='Seconds between full frames in delta mode ['
+                              + str(KEYINT) + ']',
+                        type=float, default=KEYINT)
+    parser.add_argument('--fps',
+                        help='Maximum text frame rate [' + str(FPS) + ']',
+                        type=float, default=FPS)
+    parser.add_argument('-c', '--control',
+                        help='Control and stats socket [disabled]',
+                        type=str, default=None)
+    parser.add_argument('-b', '--board',
+                        help='Display board, may be repeated: path=SOCKET'
+                             '[,size=WxH][,rows=FIRST-LAST][,offset=N]'
+                             '[,header=HEADER...]',
+                        type=boardspec, action='append', default=[])
+    parser.add_argument('--preload',
+                        help='Characters to pre-render, U+XXXX-U+YYYY '
+                             'ranges are expanded [none]',
+                        type=charset, default='')
+    parser.add_argument('--glyphcache',
+                        help='Directory for rendered fallback glyphs [none]',
+                        type=str, default=None)
+    parser.add_argument('--capture',
+                        help='Record received packets to file [disabled]',
+                        type=str, default=None)
+    parser.add_argument('--decodecache',
+                        help='Decoded packets cached, 0 to disable ['
+                              + str(DECCACHE) + ']',
+                        type=int, default=DECCACHE)
+    parser.add_argument('--tickrate',
+                        help='Clock ticks per second [' + str(TICKRATE) + ']',
+                        type=float, default=TICKRATE)
+    parser.add_argument('--profiledir',
+                        help='Directory for profile reports ['
+                              + PROFILE.outdir + ']',
+                        type=str, default=PROFILE.outdir)
     parser.add_argument('-x', '--width',
                         help='Display width in pixels [' + str(WIDTH) + ']',
                         type=int, default=WIDTH)
@@ -493,33 +2267,183 @@ def main():
                         type=int, default=HEIGHT)
     args = parser.parse_args()
 
-    # Create tableau helper thread
-    tbl = tableau(args.width, args.height, args.display)
-    tbl.start()
+    # Profile startup when requested by environment
+    PROFILE.outdir = args.profiledir
+    UNT4CACHE.maxsize = args.decodecache
+    if os.environ.get(PROFENV):
+        try:
+            PROFILE.start(float(os.environ[PROFENV]))
+        except ValueError:
+            print('caprica: Invalid {}: {}'.format(PROFENV,
+                                                 repr(os.environ[PROFENV])))
+
+    # Create tableau helper threads, sharing glyphs
+    gls = glyphset(args.preload, args.glyphcache)
+    tbl = router()
+    boards = [{'path':args.display, 'width':args.width, 'height':args.height,
+               'headers':None, 'rows':None, 'offset':0}]
+    if args.board:
+        boards = args.board
+    for b in boards:
+        t = tableau(b['width'], b['height'], b['path'],
+                    args.delta, args.keyframe, args.fps, gls, args.tickrate)
+        t.start()
+        tbl.add(t, b['headers'], b['rows'], b['offset'])
 
     # Create dhi socket server helper thread
-    dhi = receiver(('0.0.0.0', args.port), recvhandler)
+    if args.aio:
+        dhi = areceiver(('0.0.0.0', args.port), args.maxconn, args.idle)
+    else:
+        dhi = receiver(('0.0.0.0', args.port), recvhandler)
     dhi.set_tableau(tbl)
+    cap = None
+    if args.capture:
+        cap = capture(args.capture)
+        dhi.set_capture(cap)
     dhi_thread = threading.Thread(target=dhi.serve_forever)
     dhi_thread.daemon = True
     dhi_thread.start()
 
-    # Register alarm handler
-    def timeout(signum, frame):
-        """Send a clock update to the tableau."""
-        tbl.update()
-    signal.signal(signal.SIGALRM, timeout)
+    # Create control socket server helper thread
+    ctl = None
+    if args.control:
+        ctl = control(args.control, ctlhandler)
+        ctl.set_tableau(tbl)
+        ctl_thread = threading.Thread(target=ctl.serve_forever)
+        ctl_thread.daemon = True
+        ctl_thread.start()
 
-    # Set alarm for slightly after top of second, then wait
-    now=time.time()
-    then=float(int(now)+2)-now+0.01
-    signal.setitimer(signal.ITIMER_REAL,then,1.0)
+    # Register keyframe request handler
+    def keyframe(signum, frame):
+        """Force a full frame on next display update."""
+        tbl.keyframe()
+    signal.signal(signal.SIGUSR1, keyframe)
+
+    # Register profile request handler
+    def profile(signum, frame):
+        """Start a profile window."""
+        PROFILE.start()
+    signal.signal(signal.SIGUSR2, profile)
+
+    # Clock ticks are scheduled by each tableau, wait for signals
     try:
         while True:
             signal.pause()
     finally:
-        tbl.running = False
+        for t in tbl.tableaus():
+            t.running = False
         dhi.shutdown()
+        if ctl is not None:
+            ctl.shutdown()
+            ctl.server_close()
+        if cap is not None:
+            cap.close()
+
+def compile_data():
+    """Write raw A1 images and glyph atlas beside their PNG sources."""
+    for fname in (CKFACE, CKOPEN, CKCLOSE):
+        src = cairo.ImageSurface.create_from_png(fname)
+        dst = cairo.ImageSurface(cairo.FORMAT_A1, src.get_width(),
+                                 src.get_height())
+        ctx = cairo.Context(dst)
+        ctx.set_source_surface(src, 0, 0)
+        ctx.paint()
+        raw = os.path.splitext(fname)[0] + '.a1'
+        a1save(raw, dst)
+        print('caprica: Wrote ' + raw)
+    with open(GLRAW, 'wb') as f:
+        for rows in pngatlas(GLSRC):
+            f.write(bytes(rows))
+    print('caprica: Wrote ' + GLRAW)
+
+def replay():
+    """Re-inject packets from a capture file into a tableau."""
+    parser = argparse.ArgumentParser(description='Caprica Capture Replay')
+    parser.add_argument('capture', help='Capture file', type=str)
+    parser.add_argument('-s', '--speed',
+                        help='Replay speed multiple, 0 for unpaced [1.0]',
+                        type=float, default=1.0)
+    parser.add_argument('-d', '--display',
+                        help='Display socket, udp://HOST:PORT or '
+                             'tcp://HOST:PORT [' + str(DEFFB) + ']',
+                        type=str, default=DEFFB)
+    parser.add_argument('--delta',
+                        help='Send dirty-row delta frames to display socket',
+                        action='store_true')
+    parser.add_argument('--fps',
+                        help='Maximum text frame rate [' + str(FPS) + ']',
+                        type=float, default=FPS)
+    parser.add_argument('-x', '--width',
+                        help='Display width in pixels [' + str(WIDTH) + ']',
+                        type=int, default=WIDTH)
+    parser.add_argument('-y', '--height',
+                        help='Display height in pixels [' + str(HEIGHT) + ']',
+                        type=int, default=HEIGHT)
+    args = parser.parse_args()
+
+    tbl = tableau(args.width, args.height, args.display,
+                  args.delta, KEYINT, args.fps)
+    tbl.start()
+    parsers = {}
+    cnt = 0
+    st = time.monotonic()
+    t0 = None
+    try:
+        for (ts, cid, pkt) in captured(args.capture):
+            if t0 is None:
+                t0 = ts
+            if args.speed > 0:
+                dt = st + (ts - t0)/args.speed - time.monotonic()
+                if dt > 0:
+                    time.sleep(dt)
+            if cid not in parsers:
+                parsers[cid] = unt4parser()
+            for m in parsers[cid].feed(pkt):
+                tbl.update(m, args.speed <= 0)
+                cnt += 1
+            pkt.release()
+        tbl.wait()
+        time.sleep(2.0/args.fps)	# allow final frame to be sent
+    except ValueError as e:
+        print('caprica: Error reading capture: ' + str(e))
+        return
+    finally:
+        tbl.running = False
+        tbl.join()
+    elapsed = time.monotonic() - st
+    print('caprica: Replayed {0} packets in {1:0.3f}s ({2:0.1f}/s)'.format(
+            cnt, elapsed, cnt/elapsed if elapsed > 0 else 0.0))
+    print(STATS.dump(), end='')
+
+def relay():
+    """Write frames received from a network transport to a display socket."""
+    parser = argparse.ArgumentParser(description='Caprica Network Relay')
+    parser.add_argument('listen',
+                        help='Listen address udp://HOST:PORT or '
+                             'tcp://HOST:PORT',
+                        type=str)
+    parser.add_argument('-d', '--display',
+                        help='Display socket [' + str(DEFFB) + ']',
+                        type=str, default=DEFFB)
+    args = parser.parse_args()
+    try:
+        (proto, addr) = netaddr(args.listen)
+    except ValueError as e:
+        parser.error('invalid listen address {}: {}'.format(
+                      repr(args.listen), e))
+
+    if proto == 'tcp':
+        srv = relaytcp(addr, relaytcphandler)
+    else:
+        srv = relayudp(addr, relayudphandler)
+    srv.set_display(args.display)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        srv.server_close()
+        print(STATS.dump(), end='')
 
 if __name__ == '__main__':
     main()
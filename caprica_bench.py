@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+#
+# Synthetic load and latency benchmark for caprica
+#
+# Runs the real receiver and tableau against a local display sink
+# and replays traffic profiles over DHI connections.
+#
+# Imports
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+import caprica
+
+# Benchmark defaults
+DURATION = 5.0			# seconds per profile
+CLIENTS = 8			# connections for the concurrent profile
+RATE = 0			# packets per second per client, 0 for unpaced
+PROFILES = ['page', 'running', 'info', 'clients']
+
+# UNT4 packet builders
+def unt4pkt(header='', xx=None, yy=None, text='', erl=False, erp=False):
+    """Return the bytes of a UNT4 packet."""
+    ret = caprica.unt4.SOH + header.encode('utf-8') + caprica.unt4.STX
+    if erp:
+        ret += caprica.unt4.ERP
+    if yy is not None:
+        ret += caprica.unt4.DLE + '{0:02d}{1:02d}'.format(xx, yy).encode()
+    ret += text.encode('utf-8')
+    if erl:
+        ret += caprica.unt4.ERL
+    return ret + caprica.unt4.EOT
+
+def page(n):
+    """Return packets for a full results page."""
+    ret = [unt4pkt(erp=True),
+           unt4pkt(xx=0, yy=0, text='Men Elite Sprint', erl=True),
+           unt4pkt(xx=0, yy=1, text='Heat {} Result'.format(n), erl=True)]
+    for r in range(2, 6):
+        ret.append(unt4pkt(xx=0, yy=r, erl=True,
+                           text='{0:2d} Rider Name {1:4d} 10.{2:03d}'.format(
+                                r-1, n % 1000, (n*7+r) % 1000)))
+    return ret
+
+def running(n):
+    """Return a running-time line."""
+    return [unt4pkt(xx=12, yy=5, text='{0:6.2f}'.format(n*0.01), erl=True)]
+
+def info(n):
+    """Return temperature, humidity and pressure info messages."""
+    return [unt4pkt(header='DC', text='{0:0.1f}'.format(20.0+0.1*(n%50))),
+            unt4pkt(header='RH', text='{0:d}'.format(40+n%20)),
+            unt4pkt(header='BP', text='{0:d}'.format(1000+n%30))]
+
+# Counting wrapper for the tableau update path
+class counter(object):
+    def __init__(self, tbh):
+        self.tbh = tbh
+        self.lock = threading.Lock()
+        self.accepted = []	# (time, key) of queued frame messages
+        self.packets = 0
+
+    def update(self, msg=None):
+        now = time.monotonic()
+        ret = self.tbh.update(msg)	# False: an older message was evicted
+        with self.lock:
+            self.packets += 1
+            if msg is not None and (msg.erp or msg.yy is not None):
+                key = None
+                if not msg.erp:
+                    key = (msg.header, msg.yy, msg.xx)
+                self.accepted.append((now, key))
+        return ret
+
+# Display socket sink
+class sink(threading.Thread):
+    def __init__(self, path):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.sock.settimeout(0.2)
+        self.frames = []	# monotonic arrival time of each frame
+        self.nbytes = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                buf = self.sock.recv(0x10000)
+                self.frames.append(time.monotonic())
+                self.nbytes += len(buf)
+            except socket.timeout:
+                pass
+
+def client(port, gen, rate, duration, stats):
+    """Send packets from gen to port until duration expires."""
+    s = socket.create_connection(('127.0.0.1', port))
+    n = 0
+    sent = 0
+    end = time.monotonic() + duration
+    nt = time.monotonic()
+    while time.monotonic() < end:
+        pkts = gen(n)
+        s.sendall(b''.join(pkts))
+        sent += len(pkts)
+        n += 1
+        if rate:
+            nt += len(pkts)/rate
+            dt = nt - time.monotonic()
+            if dt > 0:
+                time.sleep(dt)
+    s.close()
+    stats.append(sent)
+
+def percentile(vals, p):
+    """Return the p percentile of sorted vals."""
+    if not vals:
+        return float('nan')
+    return vals[min(len(vals)-1, int(p*len(vals)))]
+
+def latency(accepted, frames):
+    """Match each accepted message to the first frame sent after it.
+
+    Messages overwritten at the same position before that frame was
+    sent were superseded and never displayed, so they are skipped.
+    """
+    accepted = sorted(accepted, key=lambda a: a[0])
+    nxt = [None] * len(accepted)	# time of next message at same position
+    seen = {}
+    for i in range(len(accepted) - 1, -1, -1):
+        (t, key) = accepted[i]
+        if key is not None:
+            nxt[i] = seen.get(key)
+            seen[key] = t
+    ret = []
+    fi = 0
+    for (i, (t, key)) in enumerate(accepted):
+        while fi < len(frames) and frames[fi] < t:
+            fi += 1
+        if fi == len(frames):
+            break
+        if nxt[i] is not None and nxt[i] < frames[fi]:
+            continue
+        ret.append(frames[fi] - t)
+    return sorted(ret)
+
+def run_profile(name, args, fba):
+    """Run one traffic profile and return a result dict."""
+    snk = sink(fba)
+    snk.start()
+    tbl = caprica.tableau(args.width, args.height, fba,
+                          args.delta, caprica.KEYINT, args.fps)
+    tbl.start()
+    cnt = counter(tbl)
+    dropped = caprica.STATS.value('messages_dropped')
+    superseded = caprica.STATS.value('messages_superseded')
+    if args.aio:
+        dhi = caprica.areceiver(('127.0.0.1', 0), args.clients+1)
+    else:
+        dhi = caprica.receiver(('127.0.0.1', 0), caprica.recvhandler)
+    dhi.set_tableau(cnt)
+    port = dhi.server_address[1]
+    dhi_thread = threading.Thread(target=dhi.serve_forever)
+    dhi_thread.daemon = True
+    dhi_thread.start()
+
+    gens = {'page':[page], 'running':[running], 'info':[info],
+            'clients':[running, page] * (args.clients//2) + [info]}
+    sent = []
+    st = time.monotonic()
+    cl = []
+    for gen in gens[name]:
+        t = threading.Thread(target=client,
+                             args=(port, gen, args.rate, args.duration, sent))
+        t.start()
+        cl.append(t)
+    for t in cl:
+        t.join()
+    dhi.shutdown()
+    if not args.aio:
+        dhi.server_close()	# wait for handlers to read remaining data
+    time.sleep(0.5)	# allow tableau to drain
+    elapsed = time.monotonic() - st
+    dropped = caprica.STATS.value('messages_dropped') - dropped
+    superseded = caprica.STATS.value('messages_superseded') - superseded
+
+    tbl.running = False
+    tbl.join()
+    snk.running = False
+    snk.join()
+    snk.sock.close()
+    os.unlink(fba)
+
+    lat = latency(cnt.accepted, snk.frames)
+    return {'profile':name, 'sent':sum(sent), 'packets':cnt.packets,
+            'dropped':dropped, 'superseded':superseded,
+            'frames':len(snk.frames),
+            'bytes':snk.nbytes, 'elapsed':elapsed,
+            'p50':1000.0*percentile(lat, 0.50),
+            'p99':1000.0*percentile(lat, 0.99)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Caprica Benchmark')
+    parser.add_argument('profile', nargs='*',
+                        help='Traffic profiles to run, from: '
+                              + ', '.join(PROFILES) + ' [all]')
+    parser.add_argument('-t', '--duration',
+                        help='Seconds per profile [' + str(DURATION) + ']',
+                        type=float, default=DURATION)
+    parser.add_argument('-c', '--clients',
+                        help='Concurrent clients [' + str(CLIENTS) + ']',
+                        type=int, default=CLIENTS)
+    parser.add_argument('-r', '--rate',
+                        help='Packets per second per client, 0 unpaced ['
+                              + str(RATE) + ']',
+                        type=float, default=RATE)
+    parser.add_argument('--async',
+                        help='Use asyncio DHI receiver',
+                        dest='aio', action='store_true')
+    parser.add_argument('--delta',
+                        help='Send dirty-row delta frames',
+                        action='store_true')
+    parser.add_argument('--fps',
+                        help='Maximum text frame rate [' + str(caprica.FPS)
+                              + ']',
+                        type=float, default=caprica.FPS)
+    parser.add_argument('-x', '--width',
+                        help='Display width [' + str(caprica.WIDTH) + ']',
+                        type=int, default=caprica.WIDTH)
+    parser.add_argument('-y', '--height',
+                        help='Display height [' + str(caprica.HEIGHT) + ']',
+                        type=int, default=caprica.HEIGHT)
+    args = parser.parse_args()
+    for name in args.profile:
+        if name not in PROFILES:
+            parser.error('unknown profile: ' + repr(name))
+
+    print('{0:<8} {1:>8} {2:>9} {3:>8} {4:>10} {5:>7} {6:>7} {7:>9} '
+          '{8:>8} {9:>8}'.format('profile', 'packets', 'pkt/s', 'dropped',
+          'superseded', 'frames', 'fps', 'bytes/s', 'p50 ms', 'p99 ms'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name in args.profile or PROFILES:
+            r = run_profile(name, args, os.path.join(tmpdir, 'display'))
+            print('{0:<8} {1:>8d} {2:>9.1f} {3:>8d} {4:>10d} {5:>7d} '
+                  '{6:>7.1f} {7:>9.0f} {8:>8.2f} {9:>8.2f}'.format(
+                  r['profile'], r['packets'], r['packets']/r['elapsed'],
+                  r['dropped'], r['superseded'], r['frames'],
+                  r['frames']/r['elapsed'], r['bytes']/r['elapsed'],
+                  r['p50'], r['p99']))
+
+if __name__ == '__main__':
+    main()
@@ -18,6 +18,9 @@ setuptools.setup(
     entry_points={
         'console_scripts': [
             'caprica=caprica:main',
+            'caprica-replay=caprica:replay',
+            'caprica-compile=caprica:compile_data',
+            'caprica-relay=caprica:relay',
         ],
     },
     classifiers=[
@@ -29,9 +32,13 @@ setuptools.setup(
     ],
     py_modules=['caprica',],
     data_files=[('data',[
+                 'data/clockface-71.a1',
                  'data/clockface-71.png',
+                 'data/clockpip-close.a1',
                  'data/clockpip-close.png',
+                 'data/clockpip-open.a1',
                  'data/clockpip-open.png',
+                 'data/ISO-8859-1.glyphs',
                  'data/ISO-8859-1.png',
                  'data/unichr-0x0030a.png',
                  'data/unichr-0x0039b.png',